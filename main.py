@@ -2,50 +2,240 @@
 # requires-python = ">=3.12"
 # dependencies = [
 #     "anthropic",
-#     "pydantic",
+#     "orjson",
 # ]
 # ///
 
 import os
 import sys
+import glob
+import atexit
+import mmap
+import asyncio
 import argparse
 import logging
-from typing import List, Dict, Any
-from anthropic import Anthropic  # type: ignore
-from pydantic import BaseModel  # type: ignore
-
-# 设置日志记录
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(message)s",
-    handlers=[logging.FileHandler("agent.log")],
+import logging.handlers
+import queue
+import stat
+import tempfile
+import threading
+import time
+import random
+import functools
+import heapq
+import io
+import itertools
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Dict, Any, Callable, Deque
+import orjson  # type: ignore
+
+try:
+    import readline  # 提供行编辑和历史记录（Windows上不可用）
+except ImportError:
+    readline = None
+
+try:
+    import termios  # 用于退出时恢复终端设置（Windows上不可用）
+except ImportError:
+    termios = None
+
+# 进程的umask只能通过设置来读取。必须在启动日志线程之前读取，
+# 否则其他线程可能在umask临时为0的窗口内创建文件
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# 设置日志记录：日志记录先放入队列，由后台线程写入按大小轮转的日志文件，
+# 避免在对话循环中同步写磁盘
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_file_handler = logging.handlers.RotatingFileHandler(
+    "agent.log", maxBytes=10 * 1024 * 1024, backupCount=3, encoding="utf-8"
+)
+_log_file_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# QueueHandler入队前会先格式化消息，这里只保留消息本身，由文件处理器统一加时间戳
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _log_file_handler, respect_handler_level=True
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # 抑制详细的HTTP日志
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
+MODEL = "claude-sonnet-4-5-20250929"
+SYSTEM_PROMPT = "你是一个在终端环境中运行的乐于助人的编程助手。只输出纯文本，不要使用markdown格式，因为你的回复会直接显示在终端中。要简洁但全面，以友好的语气提供清晰实用的建议。不要在回复中使用任何星号字符。"
+# 系统提示以块列表形式传递，并设置缓存断点以启用提示缓存
+SYSTEM_PROMPT_BLOCKS = [
+    {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+]
+# 用户输入中包含这些关键词时才开始在请求中附带工具，对话开头的纯聊天轮次省去工具模式的开销
+TOOL_KEYWORDS = (
+    "read", "edit", "file", "list", "directory", "create", "open", "write", "show", "/",
+    "找", "读", "写", "改", "创建", "列出", "文件", "目录", "编辑",
+)
+HISTORY_FILE = os.path.expanduser("~/.ai_agent_history")  # 输入历史文件
+HISTORY_LENGTH = 10000  # 保留的输入历史条数
+BATCH_POLL_INTERVAL = 20  # 批处理状态轮询间隔（秒）
+BATCH_CUSTOM_ID_PATTERN = re.compile(r"[a-zA-Z0-9_-]{1,64}")  # API对custom_id的格式要求
+MMAP_READ_THRESHOLD = 1 << 20  # 超过该大小（字节）的文件通过mmap读取
+LIST_FILES_LIMIT = 10000  # 列出目录时最多显示的条目数
+READ_CACHE_SIZE = 64  # 读取缓存最多保留的文件数
+TOOL_RESULT_MAX_CHARS = 16384  # 工具结果或读取的文件内容超过该长度时截断
+TOOL_RESULT_TRUNCATED_CHARS = 8192  # 截断后保留的字符数
+COMPACT_THRESHOLD_TOKENS = 8000  # 对话历史超过该估算令牌数时进行压缩
+COMPACT_KEEP_TURNS = 4  # 压缩时原样保留的最近轮数
+COMPACT_MIN_TOKENS = 4000  # 可压缩的新内容少于该估算令牌数时不压缩，避免每轮都调用摘要
+COMPACT_PROMPT = "请用不超过300个令牌总结以下对话，保留涉及的文件路径和已做出的决定。只输出摘要本身。"
+READ_ONLY_TOOLS = {"read_file", "list_files"}  # 可以在同一轮中并发执行的工具
+MAX_RETRIES = 5  # API暂时性错误的最大尝试次数
+RETRYABLE_ERROR_TYPES = {"overloaded_error", "api_error", "rate_limit_error"}
+MAX_REQUESTS_PER_MINUTE = 50  # 默认每分钟请求数上限，收到响应头后按账户限额调整
+MAX_TOKENS_PER_MINUTE = 30000  # 默认每分钟令牌数上限，收到响应头后按账户限额调整
+
 
-class Tool(BaseModel):
+@dataclass(slots=True)
+class Tool:
     """工具类，定义AI代理可以使用的工具"""
     name: str  # 工具名称
     description: str  # 工具描述
     input_schema: Dict[str, Any]  # 工具输入模式
 
 
+class TokenBucket:
+    """令牌桶限流器，在调用API前主动等待配额，避免触发429错误
+
+    请求数和令牌数两个桶按每分钟上限的1/60每秒匀速补充。
+    """
+
+    def __init__(
+        self,
+        max_requests_per_minute: float = MAX_REQUESTS_PER_MINUTE,
+        max_tokens_per_minute: float = MAX_TOKENS_PER_MINUTE,
+    ):
+        """初始化令牌桶
+
+        Args:
+            max_requests_per_minute: 每分钟请求数上限
+            max_tokens_per_minute: 每分钟令牌数上限
+        """
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self._lock = asyncio.Lock()  # 保证并发任务按顺序获取配额
+
+    def _refill(self):
+        """按经过的时间补充配额"""
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.max_requests_per_minute,
+            self.available_request_capacity + elapsed * self.max_requests_per_minute / 60,
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + elapsed * self.max_tokens_per_minute / 60,
+        )
+        self.last_update_time = now
+
+    async def acquire(self, requests: int = 1, tokens: int = 0):
+        """等待直到有足够的配额，然后扣除
+
+        Args:
+            requests: 需要的请求数
+            tokens: 预估需要的令牌数
+        """
+        async with self._lock:
+            while True:
+                self._refill()
+                # 单次请求的令牌数超过桶容量时，最多等到桶满
+                needed_tokens = min(tokens, self.max_tokens_per_minute)
+                if (
+                    self.available_request_capacity >= requests
+                    and self.available_token_capacity >= needed_tokens
+                ):
+                    self.available_request_capacity -= requests
+                    self.available_token_capacity -= needed_tokens
+                    return
+
+                wait = max(
+                    (requests - self.available_request_capacity)
+                    * 60
+                    / self.max_requests_per_minute,
+                    (needed_tokens - self.available_token_capacity)
+                    * 60
+                    / self.max_tokens_per_minute,
+                )
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """用实际消耗的令牌数修正预估值
+
+        Args:
+            estimated_tokens: 调用前预估的令牌数
+            actual_tokens: 响应中报告的实际令牌数
+        """
+        self._refill()
+        self.available_token_capacity -= actual_tokens - estimated_tokens
+
+    def update_limits(self, headers):
+        """根据API响应头中的账户限额调整桶容量
+
+        Args:
+            headers: API响应头
+        """
+        requests_limit = headers.get("anthropic-ratelimit-requests-limit")
+        tokens_limit = headers.get("anthropic-ratelimit-tokens-limit")
+        if requests_limit:
+            self.max_requests_per_minute = float(requests_limit)
+        if tokens_limit:
+            self.max_tokens_per_minute = float(tokens_limit)
+
+
 class AIAgent:
     """AI代理类，负责与Claude API交互和执行工具操作"""
     
-    def __init__(self, api_key: str):
+    def __init__(
+        self, api_key: str, echo: bool = True, bucket: TokenBucket | None = None
+    ):
         """初始化AI代理
         
         Args:
             api_key: Anthropic API密钥
+            echo: 是否将回复流式打印到终端
+            bucket: 限流令牌桶（多个代理可共享同一个令牌桶）
         """
-        self.client = Anthropic(api_key=api_key)  # 创建Anthropic客户端
-        self.messages: List[Dict[str, Any]] = []  # 存储对话历史
+        # 延迟导入SDK，避免在启动时加载httpx等依赖
+        from anthropic import AsyncAnthropic  # type: ignore
+
+        # 创建异步Anthropic客户端；对话请求的重试由_stream_with_retry统一处理，
+        # 关闭SDK自带的重试，避免两层重试叠加
+        self.client = AsyncAnthropic(api_key=api_key, max_retries=0)
+        self.messages: Deque[Dict[str, Any]] = deque()  # 存储对话历史，两端增删均为O(1)
+        self._history_bytes = 0  # 对话历史序列化后的总字节数，随增删增量更新
         self.tools: List[Tool] = []  # 可用工具列表
+        self.echo = echo  # 是否流式打印回复
+        self.bucket = bucket or TokenBucket()  # API调用限流
+        self._cached_block: Dict[str, Any] | None = None  # 带有缓存断点的历史消息块
+        self._tools_sent = False  # 本次对话中是否已经附带过工具
+        self._has_summary = False  # 对话历史是否以之前压缩生成的摘要对开头
         self._setup_tools()  # 设置工具
+        # 工具名称到处理函数的映射，执行工具时只需一次字典查找
+        self._dispatch: Dict[str, Callable[[Dict[str, Any]], str]] = {
+            "read_file": lambda i: self._read_file(
+                i["path"], i.get("offset", 0), i.get("limit")
+            ),
+            "list_files": lambda i: self._list_files(i.get("path", ".")),
+            "edit_file": lambda i: self._edit_file(
+                i["path"], i.get("old_text", ""), i["new_text"]
+            ),
+        }
 
     def _setup_tools(self):
         """设置可用的工具列表"""
@@ -59,7 +249,15 @@ class AIAgent:
                         "path": {
                             "type": "string",
                             "description": "要读取的文件路径",
-                        }
+                        },
+                        "offset": {
+                            "type": "integer",
+                            "description": "从文件内容的第几个字符开始读取（默认为0）",
+                        },
+                        "limit": {
+                            "type": "integer",
+                            "description": "最多读取的字符数（默认读取到文件末尾）",
+                        },
                     },
                     "required": ["path"],
                 },
@@ -80,7 +278,7 @@ class AIAgent:
             ),
             Tool(
                 name="edit_file",
-                description="通过将old_text替换为new_text来编辑文件。如果文件不存在则创建新文件。",
+                description="通过将old_text替换为new_text来编辑文件。old_text必须在文件中唯一匹配。如果文件不存在则创建新文件。",
                 input_schema={
                     "type": "object",
                     "properties": {
@@ -102,6 +300,19 @@ class AIAgent:
             ),
         ]
 
+        # 工具模式只构建一次，每次API调用发送完全相同的工具前缀；
+        # 最后一个工具带有缓存断点，使工具列表前缀可以命中提示缓存
+        self._tool_schemas: List[Dict[str, Any]] = [
+            {
+                "name": tool.name,
+                "description": tool.description,
+                "input_schema": tool.input_schema,
+            }
+            for tool in self.tools
+        ]
+        if self._tool_schemas:
+            self._tool_schemas[-1]["cache_control"] = {"type": "ephemeral"}
+
     def _execute_tool(self, tool_name: str, tool_input: Dict[str, Any]) -> str:
         """执行指定的工具
         
@@ -113,36 +324,80 @@ class AIAgent:
             工具执行结果
         """
         logging.info(f"执行工具: {tool_name} 输入: {tool_input}")
+        handler = self._dispatch.get(tool_name)
+        if handler is None:
+            return f"未知工具: {tool_name}"
         try:
-            if tool_name == "read_file":
-                return self._read_file(tool_input["path"])
-            elif tool_name == "list_files":
-                return self._list_files(tool_input.get("path", "."))
-            elif tool_name == "edit_file":
-                return self._edit_file(
-                    tool_input["path"],
-                    tool_input.get("old_text", ""),
-                    tool_input["new_text"],
-                )
-            else:
-                return f"未知工具: {tool_name}"
+            return handler(tool_input)
         except Exception as e:
             logging.error(f"执行 {tool_name} 时出错: {str(e)}")
             return f"执行 {tool_name} 时出错: {str(e)}"
 
-    def _read_file(self, path: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=READ_CACHE_SIZE)
+    def _read_cached(path: str, mtime_ns: int, size: int) -> str:
+        """读取文件内容并缓存
+
+        mtime_ns和size只作为缓存键使用，文件变化后旧条目会被LRU逐步淘汰。
+
+        Args:
+            path: 文件绝对路径
+            mtime_ns: 文件修改时间（纳秒）
+            size: 文件大小
+
+        Returns:
+            文件内容
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def _read_file(self, path: str, offset: int = 0, limit: int | None = None) -> str:
         """读取文件内容
         
         Args:
             path: 文件路径
+            offset: 起始字符位置
+            limit: 最多读取的字符数，None表示读取到文件末尾
             
         Returns:
             文件内容或错误信息
         """
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                content = f.read()
-            return f"文件 {path} 的内容:\n{content}"
+            st = os.stat(path)
+            if st.st_size > MMAP_READ_THRESHOLD:
+                # 大文件直接从页缓存映射后解码，省去读入中间缓冲区的拷贝；
+                # 映射只在本次读取期间存在
+                with open(path, "rb") as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                ) as mm:
+                    content = str(mm, "utf-8")
+                # 与文本模式读取的通用换行保持一致，字符偏移在阈值两侧含义相同
+                content = content.replace("\r\n", "\n").replace("\r", "\n")
+            else:
+                # 小文件按(路径, 修改时间, 大小)缓存，文件被修改后键随之变化；
+                # 大文件不进入缓存，缓存占用的内存因此有上限
+                content = AIAgent._read_cached(
+                    os.path.abspath(path), st.st_mtime_ns, st.st_size
+                )
+
+            total = len(content)
+            offset = min(max(offset, 0), total)
+            end = total if limit is None else min(total, offset + max(limit, 0))
+            # 过长的内容会随历史在之后每一轮重复发送，只返回开头部分；
+            # 截断按文件内容的字符计算，提示的offset可以直接用于下一次读取
+            truncated = end - offset > TOOL_RESULT_MAX_CHARS
+            if truncated:
+                end = offset + TOOL_RESULT_TRUNCATED_CHARS
+
+            if offset == 0 and end == total:
+                return f"文件 {path} 的内容:\n{content}"
+            result = (
+                f"文件 {path} 的内容（第 {offset} 到 {end} 个字符，共 {total} 个字符）:\n"
+                f"{content[offset:end]}"
+            )
+            if truncated:
+                result += f"\n...[已截断；可使用read_file的offset={end}继续读取其余内容]"
+            return result
         except FileNotFoundError:
             return f"文件未找到: {path}"
         except Exception as e:
@@ -158,24 +413,96 @@ class AIAgent:
             目录内容列表或错误信息
         """
         try:
-            if not os.path.exists(path):
-                return f"路径未找到: {path}"
-
-            items = []
-            for item in sorted(os.listdir(path)):
-                item_path = os.path.join(path, item)
-                if os.path.isdir(item_path):
-                    items.append(f"[目录]  {item}/")
-                else:
-                    items.append(f"[文件] {item}")
+            # scandir返回的DirEntry带有目录项类型信息，判断是否为目录时无需额外的stat调用；
+            # 用堆只保留按名称排序的前LIST_FILES_LIMIT项（多取一项用于判断是否截断），
+            # 超大目录不必整体载入内存排序
+            with os.scandir(path) as it:
+                entries = heapq.nsmallest(LIST_FILES_LIMIT + 1, it, key=lambda e: e.name)
 
-            if not items:
+            if not entries:
                 return f"空目录: {path}"
 
-            return f"{path} 的内容:\n" + "\n".join(items)
+            buf = io.StringIO()
+            buf.write(f"{path} 的内容:")
+            for entry in entries[:LIST_FILES_LIMIT]:
+                if entry.is_dir(follow_symlinks=False):
+                    buf.write(f"\n[目录]  {entry.name}/")
+                else:
+                    buf.write(f"\n[文件] {entry.name}")
+            if len(entries) > LIST_FILES_LIMIT:
+                buf.write(f"\n...[条目过多，仅显示前 {LIST_FILES_LIMIT} 项]")
+
+            return buf.getvalue()
+        except FileNotFoundError:
+            return f"路径未找到: {path}"
+        except NotADirectoryError:
+            return f"路径不是目录: {path}"
         except Exception as e:
             return f"列出文件时出错: {str(e)}"
 
+    def _atomic_write(self, path: str, data: str):
+        """原子地写入文件
+
+        先写入目标文件所在目录下的临时文件，再通过os.replace替换目标文件，
+        写入中途崩溃不会留下被截断的文件。符号链接会写入其指向的文件，
+        有多个硬链接的文件改为原地写入，以免断开链接。
+
+        Args:
+            path: 目标文件路径
+            data: 要写入的文本
+        """
+        target = os.path.realpath(path)
+        try:
+            target_stat = os.stat(target)
+        except FileNotFoundError:
+            target_stat = None
+
+        if target_stat is not None and target_stat.st_nlink > 1:
+            with open(target, "w", encoding="utf-8", buffering=1 << 16) as f:
+                f.write(data)
+            return
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(target), prefix=".tmp_edit_"
+        )
+        try:
+            # 64KB缓冲区与常见文件系统块大小匹配，减少大文件的write调用次数
+            with os.fdopen(fd, "w", encoding="utf-8", buffering=1 << 16) as f:
+                f.write(data)
+            if target_stat is None:
+                # mkstemp默认只有所有者可读写，改为与open()新建文件相同的权限
+                os.chmod(tmp_path, 0o666 & ~_UMASK)
+            else:
+                # 保留原文件的权限和所有者（无权修改所有者时保持当前用户）
+                os.chmod(tmp_path, stat.S_IMODE(target_stat.st_mode))
+                if hasattr(os, "chown"):
+                    try:
+                        os.chown(tmp_path, target_stat.st_uid, target_stat.st_gid)
+                    except PermissionError:
+                        pass
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _create_file(self, path: str, text: str) -> str:
+        """创建新文件（已存在时覆盖）
+
+        Args:
+            path: 文件路径
+            text: 文件内容
+
+        Returns:
+            操作结果信息
+        """
+        # 如果路径包含子目录，则创建目录
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+
+        self._atomic_write(path, text)
+        return f"成功创建 {path}"
+
     def _edit_file(self, path: str, old_text: str, new_text: str) -> str:
         """编辑文件内容
         
@@ -188,122 +515,655 @@ class AIAgent:
             操作结果信息
         """
         try:
-            if os.path.exists(path) and old_text:
-                # 文件存在且有旧文本，执行替换操作
-                with open(path, "r", encoding="utf-8") as f:
-                    content = f.read()
-
-                if old_text not in content:
-                    return f"文件中未找到文本: {old_text}"
-
-                content = content.replace(old_text, new_text)
+            content = None
+            if old_text:
+                # 直接尝试打开文件，省去单独检查文件是否存在的系统调用
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        content = f.read()
+                except FileNotFoundError:
+                    pass
 
-                with open(path, "w", encoding="utf-8") as f:
-                    f.write(content)
-
-                return f"成功编辑 {path}"
-            else:
+            if content is None:
                 # 文件不存在或没有旧文本，创建新文件
-                # 如果路径包含子目录，则创建目录
-                dir_name = os.path.dirname(path)
-                if dir_name:
-                    os.makedirs(dir_name, exist_ok=True)
+                return self._create_file(path, new_text)
 
-                with open(path, "w", encoding="utf-8") as f:
-                    f.write(new_text)
+            # 一次查找定位匹配位置，并要求旧文本在文件中唯一
+            index = content.find(old_text)
+            if index < 0:
+                return f"文件中未找到文本: {old_text}"
+            if content.find(old_text, index + 1) >= 0:
+                return f"文件中有多处匹配文本，请提供更多上下文使其唯一: {old_text}"
 
-                return f"成功创建 {path}"
+            content = content[:index] + new_text + content[index + len(old_text):]
+
+            self._atomic_write(path, content)
+            return f"成功编辑 {path}"
         except Exception as e:
             return f"编辑文件时出错: {str(e)}"
 
-    def chat(self, user_input: str) -> str:
+    def _mark_cache_breakpoint(self):
+        """在最后一条助手消息上设置缓存断点，供后续轮次复用对话前缀
+
+        同一时间只保留一个历史消息断点，避免超过API允许的断点数量。
+        """
+        content = self.messages[-1]["content"] if self.messages else None
+        if not content or isinstance(content, str):
+            return
+        if self._cached_block is not None:
+            self._cached_block.pop("cache_control", None)
+        self._cached_block = content[-1]
+        self._cached_block["cache_control"] = {"type": "ephemeral"}
+
+    async def chat(self, user_input: str) -> str:
         """与AI代理进行对话
         
         Args:
             user_input: 用户输入
             
         Returns:
-            AI代理的回复
+            AI代理的回复（echo开启时回复内容已流式打印到终端）
         """
         logging.info(f"用户输入: {user_input}")
-        self.messages.append({"role": "user", "content": user_input})
+        self._append_message({"role": "user", "content": user_input})
 
-        # 准备工具模式供API使用
-        tool_schemas = [
-            {
-                "name": tool.name,
-                "description": tool.description,
-                "input_schema": tool.input_schema,
-            }
-            for tool in self.tools
+        try:
+            reply = await self._complete(self._needs_tools(user_input))
+        except Exception as e:
+            error = f"错误: {str(e)}"
+            if self.echo:
+                print(error)
+            return error
+
+        try:
+            await self._maybe_compact()
+        except Exception as e:
+            # 压缩失败不影响本轮回复，保留完整历史
+            logging.error(f"压缩对话历史时出错: {str(e)}")
+        return reply
+
+    def _needs_tools(self, user_input: str) -> bool:
+        """判断本轮请求是否需要附带工具
+
+        工具位于提示缓存前缀的最前面，在轮次之间切换是否附带工具会让系统提示和
+        对话历史的缓存全部失效；因此一旦附带过工具，之后的轮次一直附带。
+        这也保证了历史中有tool_result时请求总是带有工具，否则API会拒绝请求。
+
+        Args:
+            user_input: 用户输入
+
+        Returns:
+            是否附带工具
+        """
+        if not self._tools_sent:
+            lowered = user_input.lower()
+            self._tools_sent = any(keyword in lowered for keyword in TOOL_KEYWORDS)
+        return self._tools_sent
+
+    def _append_message(self, message: Dict[str, Any]):
+        """追加一条消息到对话历史，并累加其序列化后的字节数
+
+        每条消息只在加入时序列化一次，估算令牌数时不必重新遍历整个历史。
+
+        Args:
+            message: 要追加的消息
+        """
+        self.messages.append(message)
+        self._history_bytes += len(orjson.dumps(message))
+
+    def _prepend_message(self, message: Dict[str, Any]):
+        """在对话历史开头插入一条消息，并累加其序列化后的字节数
+
+        Args:
+            message: 要插入的消息
+        """
+        self.messages.appendleft(message)
+        self._history_bytes += len(orjson.dumps(message))
+
+    def _pop_oldest_message(self) -> Dict[str, Any]:
+        """弹出最早的一条消息，并扣除其序列化后的字节数
+
+        Returns:
+            被弹出的消息
+        """
+        message = self.messages.popleft()
+        self._history_bytes -= len(orjson.dumps(message))
+        return message
+
+    def _estimate_tokens(self) -> int:
+        """粗略估算对话历史的令牌数（按序列化后约4个字节一个令牌）
+
+        Returns:
+            估算的令牌数
+        """
+        return self._history_bytes // 4
+
+    async def _maybe_compact(self):
+        """对话历史过长时，将较早的轮次压缩为一条摘要
+
+        只在用户真正输入的消息处切分，保证tool_use和tool_result成对保留。
+        最近几轮本身就很长时，可压缩的部分只剩上次的摘要或很少的新内容，
+        此时不再压缩，避免每轮都阻塞在一次摘要调用上。
+        """
+        if self._estimate_tokens() <= COMPACT_THRESHOLD_TOKENS:
+            return
+
+        # 每轮对话以内容为字符串的用户消息开始（工具结果消息的内容是列表）
+        turn_starts = [
+            i
+            for i, message in enumerate(self.messages)
+            if message["role"] == "user" and isinstance(message["content"], str)
         ]
+        if len(turn_starts) <= COMPACT_KEEP_TURNS:
+            return
+        split = turn_starts[-COMPACT_KEEP_TURNS]
+
+        # 上次的摘要对不算新内容；新内容太少时压缩几乎不能缩短历史
+        summary_length = 2 if self._has_summary else 0
+        if split <= summary_length:
+            return
+        new_bytes = sum(
+            len(orjson.dumps(message))
+            for message in itertools.islice(self.messages, summary_length, split)
+        )
+        if new_bytes // 4 < COMPACT_MIN_TOKENS:
+            return
+
+        transcript = orjson.dumps(list(itertools.islice(self.messages, split)))
+        estimated_tokens = len(transcript) // 4
+        await self.bucket.acquire(1, estimated_tokens)
+        # 压缩请求不经过_stream_with_retry，恢复SDK默认的重试
+        response = await self.client.with_options(max_retries=2).messages.create(
+            model=MODEL,
+            max_tokens=1024,
+            system=COMPACT_PROMPT,
+            messages=[{"role": "user", "content": transcript.decode("utf-8")}],
+        )
+        self.bucket.settle(
+            estimated_tokens,
+            response.usage.input_tokens + response.usage.output_tokens,
+        )
+
+        summary = _response_text(response)
+        logging.info(f"已将前 {split} 条消息压缩为摘要: {summary[:500]}...")
+        # 摘要成功后再从左端弹出被压缩的消息，失败时历史保持不变
+        for _ in range(split):
+            self._pop_oldest_message()
+        self._prepend_message({"role": "assistant", "content": summary})
+        self._prepend_message({"role": "user", "content": "之前的对话摘要是什么？"})
+        self._has_summary = True
+
+        remaining = self._estimate_tokens()
+        if remaining > COMPACT_THRESHOLD_TOKENS:
+            logging.info(
+                f"压缩后对话历史仍约有 {remaining} 个令牌，最近 {COMPACT_KEEP_TURNS} 轮本身过长"
+            )
+
+    async def _stream_with_retry(self, request: Dict[str, Any]):
+        """流式调用Claude API，遇到暂时性错误时以指数退避加随机抖动重试
+
+        只重试连接错误（包括读取流时的连接中断）、429、5xx以及流中途返回的过载错误；消息只在成功后才加入历史，
+        重试不会重复追加。流中途出错时已输出的文本会保留，重试时作为助手回复的开头
+        发送给API，让模型从中断处继续，而不是重新输出整段回复。
+
+        Args:
+            request: messages.stream的参数
+
+        Returns:
+            完整解析的API消息（包含重试前已收到的文本）
+        """
+        import httpx  # type: ignore
+        from anthropic import APIConnectionError, APIStatusError  # type: ignore
+        from anthropic.types import TextBlock  # type: ignore
+
+        partial = ""  # 之前失败的尝试中已收到的文本
+        for attempt in range(MAX_RETRIES):
+            # 粗略估算本次请求的令牌数，等待限流配额
+            estimated_tokens = self._estimate_tokens()
+            await self.bucket.acquire(1, estimated_tokens)
 
+            attempt_request = request
+            if partial:
+                attempt_request = {
+                    **request,
+                    "messages": request["messages"]
+                    + [{"role": "assistant", "content": partial}],
+                }
+
+            received = []
+            try:
+                # 以流式方式调用Claude API，文本增量到达即输出到终端
+                async with self.client.messages.stream(**attempt_request) as stream:
+                    self.bucket.update_limits(stream.response.headers)
+                    async for event in stream:
+                        if event.type == "text":
+                            received.append(event.text)
+                            if self.echo:
+                                print(event.text, end="", flush=True)
+                    # 流结束后获取完整解析的消息（包含拼装好的tool_use输入）
+                    response = await stream.get_final_message()
+            except (APIConnectionError, APIStatusError, httpx.TransportError) as e:
+                # SDK只在发送请求时把传输错误包装为APIConnectionError，
+                # 读取SSE流的过程中连接中断会直接抛出httpx.TransportError
+                if not _is_retryable(e) or attempt == MAX_RETRIES - 1:
+                    raise
+                # API不接受以空白结尾的助手回复开头
+                partial = (partial + "".join(received)).rstrip()
+                delay = min(30, 2**attempt) + random.random()
+                logging.warning(f"API调用出错，{delay:.1f} 秒后重试: {str(e)}")
+                if self.echo:
+                    print(f"\n[API调用出错，{delay:.1f} 秒后从中断处继续...]")
+                await asyncio.sleep(delay)
+                continue
+
+            self.bucket.settle(
+                estimated_tokens,
+                response.usage.input_tokens + response.usage.output_tokens,
+            )
+            if partial:
+                # 把重试前收到的文本拼回回复开头，历史中保存完整的回复
+                if response.content and response.content[0].type == "text":
+                    response.content[0].text = partial + response.content[0].text
+                else:
+                    response.content.insert(0, TextBlock(type="text", text=partial))
+            return response
+
+    async def _complete(self, use_tools: bool = True) -> str:
+        """反复调用Claude API并执行工具，直到得到不含工具调用的最终回复
+
+        Args:
+            use_tools: 是否在请求中附带工具
+
+        Returns:
+            最终回复的文本
+        """
         while True:
+            request = {
+                "model": MODEL,
+                "max_tokens": 4096,
+                "system": SYSTEM_PROMPT_BLOCKS,
+                "messages": list(self.messages),
+            }
+            if use_tools:
+                request["tools"] = self._tool_schemas
+
+            response = await self._stream_with_retry(request)
+
+            if not await self._handle_response(response):
+                # 没有工具调用，本轮结束，返回最终回复的完整文本
+                self._mark_cache_breakpoint()
+                return _response_text(response)
+
+            # 还要继续调用API，在本次输出的文本和下一次的文本之间换行
+            if self.echo and _response_text(response):
+                print()
+
+    async def _handle_response(self, response) -> bool:
+        """记录助手消息并执行其中的工具调用
+
+        Args:
+            response: Claude API返回的消息
+
+        Returns:
+            是否执行了工具调用（为True时需要继续对话）
+        """
+        assistant_message = {"role": "assistant", "content": []}
+
+        for content in response.content:
+            if content.type == "text":
+                assistant_message["content"].append(
+                    {"type": "text", "text": content.text}
+                )
+            elif content.type == "tool_use":
+                assistant_message["content"].append(
+                    {
+                        "type": "tool_use",
+                        "id": content.id,
+                        "name": content.name,
+                        "input": content.input,
+                    }
+                )
+
+        self._append_message(assistant_message)
+
+        tool_use_blocks = [
+            content for content in response.content if content.type == "tool_use"
+        ]
+        if not tool_use_blocks:
+            return False
+
+        # 执行工具调用：工具在线程中运行，避免文件I/O阻塞事件循环。
+        # 相邻的只读工具调用并发执行；写入类工具按顺序单独执行，
+        # 保证同一文件的多次编辑和编辑前后的读取不会互相覆盖
+        results = []
+        pending = []
+        for content in tool_use_blocks:
+            call = asyncio.to_thread(self._execute_tool, content.name, content.input)
+            if content.name in READ_ONLY_TOOLS:
+                pending.append(call)
+                continue
+            results.extend(await asyncio.gather(*pending))
+            pending = []
+            results.append(await call)
+        results.extend(await asyncio.gather(*pending))
+
+        tool_results = []
+        for content, result in zip(tool_use_blocks, results):
+            logging.info(f"工具结果: {result[:500]}...")  # 记录前500个字符
+            # 大结果会随历史在之后每一轮重复发送，只保留开头部分。
+            # read_file已按文件内容自行截断并给出续读的offset，不再二次截断，
+            # 否则返回内容与其标明的字符范围不一致
+            if content.name != "read_file" and len(result) > TOOL_RESULT_MAX_CHARS:
+                result = (
+                    result[:TOOL_RESULT_TRUNCATED_CHARS]
+                    + f"\n...[已截断，共 {len(result)} 个字符]"
+                )
+            tool_results.append(
+                {
+                    "type": "tool_result",
+                    "tool_use_id": content.id,
+                    "content": result,
+                }
+            )
+
+        self._append_message({"role": "user", "content": tool_results})
+        return True
+
+
+def _is_retryable(error) -> bool:
+    """判断API错误是否为值得重试的暂时性错误
+
+    流中途通过SSE error事件返回的错误（如overloaded_error）发生在200响应之后，
+    SDK抛出的APIStatusError状态码为200，因此还要检查错误体中的类型。
+
+    Args:
+        error: APIConnectionError、APIStatusError或httpx.TransportError
+
+    Returns:
+        是否应当重试
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        return True  # 连接错误或读取流时的传输错误
+    if status_code == 429 or status_code >= 500:
+        return True
+    body = getattr(error, "body", None)
+    error_type = None
+    if isinstance(body, dict):
+        error_type = (body.get("error") or {}).get("type") or body.get("type")
+    return error_type in RETRYABLE_ERROR_TYPES
+
+
+def _response_text(response) -> str:
+    """拼接消息中所有文本块的内容
+
+    Args:
+        response: Claude API返回的消息
+
+    Returns:
+        文本内容
+    """
+    return "".join(
+        content.text for content in response.content if content.type == "text"
+    )
+
+
+def _load_batch_prompts(path: str) -> List[Dict[str, str]]:
+    """读取并校验批处理提示文件
+
+    文件每行是一个JSON值：可以是提示字符串，也可以是包含"prompt"和可选"custom_id"的对象。
+    未指定custom_id的提示自动编号为prompt-N，并跳过已被显式使用的编号。
+
+    Args:
+        path: JSONL文件路径
+
+    Returns:
+        包含custom_id和prompt的字典列表
+
+    Raises:
+        OSError: 文件无法读取
+        ValueError: 文件内容格式不正确
+    """
+    items = []
+    with open(path, "rb") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
             try:
-                # 调用Claude API
-                response = self.client.messages.create(
-                    model="claude-sonnet-4-5-20250929",
-                    max_tokens=4096,
-                    system="你是一个在终端环境中运行的乐于助人的编程助手。只输出纯文本，不要使用markdown格式，因为你的回复会直接显示在终端中。要简洁但全面，以友好的语气提供清晰实用的建议。不要在回复中使用任何星号字符。",
-                    messages=self.messages,
-                    tools=tool_schemas,
+                item = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                raise ValueError(f"{path} 第 {line_number} 行不是有效的JSON: {e}")
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not isinstance(item, dict):
+                raise ValueError(f"{path} 第 {line_number} 行必须是字符串或对象")
+            prompt = item.get("prompt")
+            if not isinstance(prompt, str) or not prompt.strip():
+                raise ValueError(f'{path} 第 {line_number} 行缺少非空的"prompt"字符串')
+            custom_id = item.get("custom_id")
+            if custom_id is not None and not (
+                isinstance(custom_id, str) and BATCH_CUSTOM_ID_PATTERN.fullmatch(custom_id)
+            ):
+                raise ValueError(
+                    f"{path} 第 {line_number} 行的custom_id必须由1到64个字母、数字、_或-组成"
                 )
+            items.append((line_number, custom_id, prompt))
 
-                # 处理API响应
-                assistant_message = {"role": "assistant", "content": []}
-
-                for content in response.content:
-                    if content.type == "text":
-                        assistant_message["content"].append(
-                            {"type": "text", "text": content.text}
-                        )
-                    elif content.type == "tool_use":
-                        assistant_message["content"].append(
-                            {
-                                "type": "tool_use",
-                                "id": content.id,
-                                "name": content.name,
-                                "input": content.input,
-                            }
-                        )
-
-                self.messages.append(assistant_message)
-
-                # 执行工具调用
-                tool_results = []
-                for content in response.content:
-                    if content.type == "tool_use":
-                        result = self._execute_tool(content.name, content.input)
-                        logging.info(
-                            f"工具结果: {result[:500]}..."
-                        )  # 记录前500个字符
-                        tool_results.append(
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": content.id,
-                                "content": result,
-                            }
-                        )
-
-                # 如果有工具结果，继续对话
-                if tool_results:
-                    self.messages.append({"role": "user", "content": tool_results})
-                else:
-                    # 没有工具调用，返回最终回复
-                    return response.content[0].text if response.content else ""
+    if not items:
+        raise ValueError(f"批处理文件中没有提示: {path}")
 
-            except Exception as e:
-                return f"错误: {str(e)}"
+    used_ids = set()
+    for line_number, custom_id, _ in items:
+        if custom_id is None:
+            continue
+        if custom_id in used_ids:
+            raise ValueError(f"{path} 第 {line_number} 行的custom_id重复: {custom_id}")
+        used_ids.add(custom_id)
 
+    prompts = []
+    next_number = 0
+    for _, custom_id, prompt in items:
+        if custom_id is None:
+            while f"prompt-{next_number}" in used_ids:
+                next_number += 1
+            custom_id = f"prompt-{next_number}"
+            used_ids.add(custom_id)
+        prompts.append({"custom_id": custom_id, "prompt": prompt})
+    return prompts
 
-def main():
-    """主函数，程序入口点"""
+
+async def run_batch(api_key: str, prompts: List[Dict[str, str]], output_file: str):
+    """通过Message Batches API批量处理提示
+
+    单轮提示直接使用批处理结果；模型请求调用工具的提示回退到实时API完成工具循环。
+
+    Args:
+        api_key: Anthropic API密钥
+        prompts: 由_load_batch_prompts读取的提示列表
+        output_file: 结果JSONL文件路径
+    """
+    from anthropic.types.message_create_params import MessageCreateParamsNonStreaming  # type: ignore
+    from anthropic.types.messages.batch_create_params import Request  # type: ignore
+
+    # 所有回退到实时API的任务共享同一个令牌桶，使总请求速率保持在限额内
+    bucket = TokenBucket()
+    agent = AIAgent(api_key, echo=False, bucket=bucket)
+
+    # 批处理接口不经过_stream_with_retry，恢复SDK默认的重试
+    batch_client = agent.client.with_options(max_retries=2)
+    batch = await batch_client.messages.batches.create(
+        requests=[
+            Request(
+                custom_id=item["custom_id"],
+                params=MessageCreateParamsNonStreaming(
+                    model=MODEL,
+                    max_tokens=4096,
+                    system=SYSTEM_PROMPT_BLOCKS,
+                    messages=[{"role": "user", "content": item["prompt"]}],
+                    tools=agent._tool_schemas,
+                ),
+            )
+            for item in prompts
+        ]
+    )
+    logging.info(f"已提交批处理: {batch.id}")
+    print(f"已提交批处理 {batch.id}，共 {len(prompts)} 个提示")
+
+    # 定期轮询处理状态，避免过于频繁的请求
+    while batch.processing_status != "ended":
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await batch_client.messages.batches.retrieve(batch.id)
+        print(f"批处理状态: {batch.processing_status}")
+
+    records: Dict[str, Dict[str, Any]] = {}
+    fallbacks = []
+    async for entry in await batch_client.messages.batches.results(batch.id):
+        if entry.result.type != "succeeded":
+            error = getattr(entry.result, "error", None)
+            records[entry.custom_id] = {
+                "custom_id": entry.custom_id,
+                "status": entry.result.type,
+                "error": error.model_dump(mode="json") if error else None,
+            }
+        elif entry.result.message.stop_reason == "tool_use":
+            fallbacks.append((entry.custom_id, entry.result.message))
+        else:
+            records[entry.custom_id] = {
+                "custom_id": entry.custom_id,
+                "status": "succeeded",
+                "response": _response_text(entry.result.message),
+            }
+
+    # 需要调用工具的提示从批处理结果继续，通过实时API并发完成剩余对话
+    prompts_by_id = {item["custom_id"]: item["prompt"] for item in prompts}
+
+    async def _fallback(custom_id: str, message):
+        logging.info(f"批处理提示 {custom_id} 需要工具调用，回退到实时API")
+        fallback_agent = AIAgent(api_key, echo=False, bucket=bucket)
+        fallback_agent._append_message(
+            {"role": "user", "content": prompts_by_id[custom_id]}
+        )
+        try:
+            await fallback_agent._handle_response(message)
+            records[custom_id] = {
+                "custom_id": custom_id,
+                "status": "succeeded",
+                "response": await fallback_agent._complete(),
+            }
+        except Exception as e:
+            records[custom_id] = {
+                "custom_id": custom_id,
+                "status": "errored",
+                "error": str(e),
+            }
+
+    await asyncio.gather(
+        *[_fallback(custom_id, message) for custom_id, message in fallbacks]
+    )
+
+    with open(output_file, "wb") as f:
+        for item in prompts:
+            record = records.get(
+                item["custom_id"],
+                {"custom_id": item["custom_id"], "status": "missing"},
+            )
+            f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
+    print(f"批处理完成，结果已写入 {output_file}")
+
+
+_path_matches: List[str] = []  # 当前一次补全的候选路径
+
+
+def _complete_path(text: str, state: int) -> str | None:
+    """readline补全函数，补全文件路径
+
+    readline对每个候选项以递增的state各调用一次，只在state为0时查找候选路径，
+    之后的调用直接从缓存中取，避免每次都重新glob并对所有匹配项调用stat。
+
+    Args:
+        text: 当前待补全的文本
+        state: 第几个候选项
+
+    Returns:
+        候选路径，没有更多候选项时返回None
+    """
+    global _path_matches
+    if state == 0:
+        _path_matches = sorted(
+            match + "/" if os.path.isdir(match) else match
+            for match in glob.glob(glob.escape(text) + "*")
+        )
+    return _path_matches[state] if state < len(_path_matches) else None
+
+
+def _setup_readline():
+    """启用行编辑、持久化输入历史和文件路径补全"""
+    if readline is None:
+        return
+
+    try:
+        readline.read_history_file(HISTORY_FILE)
+    except OSError:
+        # 首次运行时历史文件不存在
+        pass
+    readline.set_history_length(HISTORY_LENGTH)
+    atexit.register(readline.write_history_file, HISTORY_FILE)
+
+    readline.set_completer(_complete_path)
+    readline.set_completer_delims(" \t\n\"'")
+    if "libedit" in (readline.__doc__ or ""):
+        # macOS自带的readline基于libedit，绑定语法不同
+        readline.parse_and_bind("bind ^I rl_complete")
+    else:
+        readline.parse_and_bind("tab: complete")
+
+
+async def _ainput(prompt: str) -> str:
+    """在守护线程中读取用户输入，避免阻塞事件循环
+
+    使用守护线程而不是默认线程池，这样按Ctrl+C退出时不必等待阻塞中的input()返回。
+
+    Args:
+        prompt: 输入提示符
+
+    Returns:
+        用户输入的文本
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def _reader():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(_resolve, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, future.set_result, line)
+
+    threading.Thread(target=_reader, daemon=True).start()
+    return await future
+
+
+async def amain():
+    """异步主函数，驱动对话循环"""
     parser = argparse.ArgumentParser(
         description="AI代码助手 - 具有文件编辑功能的对话式AI代理"
     )
     parser.add_argument(
         "--api-key", help="Anthropic API密钥（或设置ANTHROPIC_API_KEY环境变量）"
     )
+    parser.add_argument(
+        "--batch", help="提示JSONL文件，通过Message Batches API批量处理后退出"
+    )
+    parser.add_argument(
+        "--batch-output", help="批处理结果JSONL文件（默认为<batch文件名>.results.jsonl）"
+    )
     args = parser.parse_args()
 
     # 获取API密钥（命令行参数或环境变量）
@@ -314,8 +1174,22 @@ def main():
         )
         sys.exit(1)
 
+    # 批处理模式：不进入交互式对话
+    if args.batch:
+        output_file = args.batch_output or (
+            os.path.splitext(args.batch)[0] + ".results.jsonl"
+        )
+        try:
+            prompts = _load_batch_prompts(args.batch)
+        except (OSError, ValueError) as e:
+            print(f"错误: {str(e)}")
+            sys.exit(1)
+        await run_batch(api_key, prompts, output_file)
+        return
+
     # 创建AI代理实例
     agent = AIAgent(api_key)
+    _setup_readline()
 
     print("AI代码助手")
     print("================")
@@ -326,7 +1200,7 @@ def main():
     # 主对话循环
     while True:
         try:
-            user_input = input("你: ").strip()
+            user_input = (await _ainput("你: ")).strip()
 
             if user_input.lower() in ["exit", "quit"]:
                 print("再见！")
@@ -336,17 +1210,35 @@ def main():
                 continue
 
             print("\n助手: ", end="", flush=True)
-            response = agent.chat(user_input)
-            print(response)
+            await agent.chat(user_input)  # 回复以流式方式直接打印
+            print()
             print()
 
-        except KeyboardInterrupt:
-            print("\n\n再见！")
+        except EOFError:
+            print("\n再见！")
             break
         except Exception as e:
             print(f"\n错误: {str(e)}")
             print()
 
 
+def main():
+    """主函数，程序入口点"""
+    # 输入在守护线程中读取，按Ctrl+C退出时readline来不及恢复终端，
+    # 会让终端停留在关闭回显的原始模式，因此先保存终端设置，退出时恢复
+    saved_tty = None
+    if termios is not None and sys.stdin.isatty():
+        saved_tty = termios.tcgetattr(sys.stdin.fileno())
+
+    try:
+        asyncio.run(amain())
+    except KeyboardInterrupt:
+        # asyncio.run在收到Ctrl+C时会取消主任务并重新抛出KeyboardInterrupt
+        print("\n\n再见！")
+    finally:
+        if saved_tty is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, saved_tty)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file